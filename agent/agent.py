@@ -1,16 +1,81 @@
-import socketio
 import platform
 import uuid
-import psutil
+import socket
 import logging
 import subprocess
 import time
 import os
 import json
-import requests
-import urllib3
 import threading
 import random
+import re
+import sys
+import hashlib
+import base64
+import shutil
+import signal
+import mmap
+import struct
+import csv
+import glob
+import ipaddress
+import math
+import heapq
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+AGENT_VERSION = "1.2.0"
+AGENT_FILE = os.path.abspath(__file__)
+
+# --- UPDATE ROLLBACK GUARD ---
+# Runs before the third-party imports so a self-update that fails to import (missing dependency,
+# module-level error) is still rolled back to agent.py.bak instead of crash-looping forever.
+UPDATE_PENDING_FILE = 'agent_update_pending.json'
+UPDATE_FAILED_FILE = 'agent_update_failed.json'
+UPDATE_MAX_STARTS = 3
+
+def restore_previous_agent(reason):
+    try:
+        with open(UPDATE_PENDING_FILE, 'r') as f:
+            pending = json.load(f)
+    except (OSError, ValueError):
+        pending = {}
+    backup = AGENT_FILE + '.bak'
+    if os.path.exists(backup):
+        os.replace(backup, AGENT_FILE)
+    # Remember the bad release so the updater does not install it again
+    with open(UPDATE_FAILED_FILE, 'w') as f:
+        json.dump({'sha256': pending.get('sha256'), 'version': pending.get('version'), 'reason': reason}, f)
+    if os.path.exists(UPDATE_PENDING_FILE):
+        os.remove(UPDATE_PENDING_FILE)
+    print(f"⏪ Rolled back update {pending.get('version')}: {reason}")
+
+def check_pending_update():
+    # Every start of an unconfirmed update counts; connect() confirms it by removing the marker
+    if not os.path.exists(UPDATE_PENDING_FILE):
+        return
+    try:
+        with open(UPDATE_PENDING_FILE, 'r') as f:
+            pending = json.load(f)
+    except (OSError, ValueError):
+        pending = {}
+    pending['starts'] = pending.get('starts', 0) + 1
+    if pending['starts'] > UPDATE_MAX_STARTS:
+        restore_previous_agent(f"did not connect within {UPDATE_MAX_STARTS} starts")
+        os.execv(sys.executable, [sys.executable, AGENT_FILE] + sys.argv[1:])
+    with open(UPDATE_PENDING_FILE, 'w') as f:
+        json.dump(pending, f)
+
+if __name__ == '__main__':
+    check_pending_update()
+
+import socketio
+import psutil
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 
 # Disable warnings for self-signed certificates (OPNsense Localhost)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -18,9 +83,18 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # --- CONFIGURATION LOADER ---
 CONFIG_FILE = 'agent_config.json'
 BLOCK_LIST_FILE = 'blocked_apps.json'
+HANDOVER_FILE = 'agent_handover.json'
 config = {}
 blocked_apps_state = set()
 
+# Outbound messages buffered while the server is unreachable (or across a self-update restart)
+heartbeat_queue = deque(maxlen=720)
+proxy_heartbeat_queues = {}         # per proxied firewall, so a large fleet cannot evict each other
+alert_queue = deque(maxlen=500)
+anomaly_queue = deque(maxlen=200)
+queue_lock = threading.Lock()       # held while draining or snapshotting the queues
+restarting = threading.Event()
+
 def load_config():
     global config
     save_needed = False
@@ -46,9 +120,14 @@ def load_config():
         save_needed = True
 
     if save_needed:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f)
-            print("✅ Configuration saved! Starting agent...\n")
+        save_config()
+        print("✅ Configuration saved! Starting agent...\n")
+
+def save_config():
+    tmp = CONFIG_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(config, f)
+    os.replace(tmp, CONFIG_FILE)
 
 def load_blocked_apps():
     global blocked_apps_state
@@ -63,9 +142,47 @@ def save_blocked_apps():
     with open(BLOCK_LIST_FILE, 'w') as f:
         json.dump(list(blocked_apps_state), f)
 
+def queue_heartbeat(stats):
+    # Caller holds queue_lock (or runs before any other thread starts)
+    if stats.get('id') in (None, config.get('agent_id')):
+        heartbeat_queue.append(stats)
+    else:
+        queue = proxy_heartbeat_queues.get(stats['id'])
+        if queue is None:
+            queue = proxy_heartbeat_queues[stats['id']] = deque(maxlen=config.get('proxy_queue_size', 120))
+        queue.append(stats)
+
+def save_handover():
+    # Persist queued messages so the re-exec'd process can send them
+    state = {
+        'saved_at': time.time(),
+        'heartbeats': list(heartbeat_queue) + [hb for q in proxy_heartbeat_queues.values() for hb in q],
+        'alerts': list(alert_queue),
+        'anomalies': list(anomaly_queue)
+    }
+    tmp = HANDOVER_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, HANDOVER_FILE)
+
+def load_handover():
+    if not os.path.exists(HANDOVER_FILE):
+        return
+    try:
+        with open(HANDOVER_FILE, 'r') as f:
+            state = json.load(f)
+        for stats in state.get('heartbeats', []):
+            queue_heartbeat(stats)
+        alert_queue.extend(state.get('alerts', []))
+        anomaly_queue.extend(state.get('anomalies', []))
+    except (OSError, ValueError):
+        pass
+    os.remove(HANDOVER_FILE)
+
 # Init
 load_config()
 load_blocked_apps()
+load_handover()
 
 SERVER_URL = config.get('server_url')
 API_KEY = config.get('api_key')
@@ -78,11 +195,363 @@ logger = logging.getLogger(__name__)
 # Socket.IO Client
 sio = socketio.Client()
 
+# --- ANOMALY DETECTION ---
+class AnomalyDetector:
+    """
+    Streaming baselines for heartbeat metrics, kept in fixed-size arrays (one slot/row per metric):
+    an EWMA mean and variance for z-scores, a slow long-term mean, a time-of-day baseline in
+    15-minute slots for the daily pattern, and a ring buffer of recent samples for the summary.
+    Each time-of-day slot is only updated when the slot ends, with that slot's mean, using its own
+    season_alpha, so it remembers the same quarter hour over the last few days. Values back near
+    the long-term mean are never flagged, so the return from a spike does not alert a second time.
+    Baselines are saved to state_file so restarts and self-updates do not relearn them.
+    """
+    METRICS = ('cpu', 'ram', 'disk')
+    SLOT_MINUTES = 15
+    SLOTS = 24 * 60 // SLOT_MINUTES
+
+    def __init__(self, window=120, alpha=0.05, long_alpha=0.001, season_alpha=0.3, threshold=3.0, min_delta=10.0,
+                 warmup=30, state_file=None, save_interval=600):
+        self.window = window
+        self.alpha = alpha
+        self.long_alpha = long_alpha
+        self.season_alpha = season_alpha
+        self.threshold = threshold
+        self.min_delta = min_delta      # ignore statistically "large" moves on very flat metrics
+        self.warmup = warmup
+        self.state_file = state_file
+        self.save_interval = save_interval
+        self.last_save = time.time()
+        n = len(self.METRICS)
+        self.mean = array('d', [0.0] * n)
+        self.var = array('d', [0.0] * n)
+        self.long_mean = array('d', [0.0] * n)
+        self.seasonal = array('d', [math.nan] * (n * self.SLOTS))
+        self.slot_sum = array('d', [0.0] * n)
+        self.slot_count = array('d', [0.0] * n)
+        self.current_slot = None
+        self.recent = array('d', [0.0] * (n * window))
+        self.recent_count = 0           # ring position; not persisted, unlike the baselines
+        self.count = 0
+        self.active = [False] * n
+        self.lock = threading.Lock()
+        self.load()
+
+    def slot_of(self, now):
+        local = time.localtime(now)
+        return (local.tm_hour * 60 + local.tm_min) // self.SLOT_MINUTES
+
+    def update(self, stats, now=None):
+        """Feed one sample; returns the anomalies that started with it."""
+        now = time.time() if now is None else now
+        slot_of_day = self.slot_of(now)
+        anomalies = []
+        with self.lock:
+            if slot_of_day != self.current_slot:
+                self._close_slot()
+                self.current_slot = slot_of_day
+            slot = self.recent_count % self.window
+            for i, metric in enumerate(self.METRICS):
+                value = stats.get(metric)
+                if value is None:
+                    continue
+                value = float(value)
+                mean, var = self.mean[i], self.var[i]
+                seasonal = self.seasonal[i * self.SLOTS + slot_of_day]
+
+                if self.count >= self.warmup:
+                    std = math.sqrt(var) or 1e-9
+                    z = (value - mean) / std
+                    expected = mean if math.isnan(seasonal) else seasonal
+                    deviates = abs(z) >= self.threshold and abs(value - mean) >= self.min_delta \
+                        and abs(value - expected) >= self.min_delta \
+                        and abs(value - self.long_mean[i]) >= self.min_delta
+                    # Only report the transition into an anomalous state; re-arm once back near baseline
+                    if deviates and not self.active[i]:
+                        anomalies.append({
+                            'metric': metric,
+                            'value': value,
+                            'z': round(z, 2),
+                            'baseline': round(mean, 2),
+                            'seasonal': None if math.isnan(seasonal) else round(seasonal, 2),
+                            'std': round(std, 2)
+                        })
+                    if deviates:
+                        self.active[i] = True
+                    elif abs(z) < self.threshold / 2:
+                        self.active[i] = False
+
+                if self.count == 0:
+                    self.mean[i] = value
+                    self.long_mean[i] = value
+                else:
+                    diff = value - mean
+                    self.mean[i] = mean + self.alpha * diff
+                    self.var[i] = (1 - self.alpha) * (var + self.alpha * diff * diff)
+                    self.long_mean[i] += self.long_alpha * (value - self.long_mean[i])
+                self.slot_sum[i] += value
+                self.slot_count[i] += 1
+                self.recent[i * self.window + slot] = value
+            self.count += 1
+            self.recent_count += 1
+        if self.state_file and now - self.last_save >= self.save_interval:
+            self.save()
+        return anomalies
+
+    def _close_slot(self):
+        # Fold the finished slot's mean into its time-of-day bucket
+        if self.current_slot is None:
+            return
+        for i in range(len(self.METRICS)):
+            if self.slot_count[i]:
+                slot_mean = self.slot_sum[i] / self.slot_count[i]
+                bucket = i * self.SLOTS + self.current_slot
+                seasonal = self.seasonal[bucket]
+                self.seasonal[bucket] = slot_mean if math.isnan(seasonal) else seasonal + self.season_alpha * (slot_mean - seasonal)
+            self.slot_sum[i] = 0.0
+            self.slot_count[i] = 0.0
+
+    def save(self):
+        if not self.state_file:
+            return
+        with self.lock:
+            state = {
+                'metrics': list(self.METRICS),
+                'slots': self.SLOTS,
+                'count': self.count,
+                'current_slot': self.current_slot,
+                'mean': list(self.mean),
+                'var': list(self.var),
+                'long_mean': list(self.long_mean),
+                'seasonal': [None if math.isnan(v) else v for v in self.seasonal],
+                'slot_sum': list(self.slot_sum),
+                'slot_count': list(self.slot_count)
+            }
+            self.last_save = time.time()
+        try:
+            tmp = self.state_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self.state_file)
+        except OSError as e:
+            logger.error(f"Failed to save anomaly baseline: {e}")
+
+    def load(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            if state.get('metrics') != list(self.METRICS) or state.get('slots') != self.SLOTS:
+                return      # saved by a version with a different layout: relearn
+            n = len(self.METRICS)
+            self.mean = array('d', state['mean'][:n])
+            self.var = array('d', state['var'][:n])
+            self.long_mean = array('d', state['long_mean'][:n])
+            self.seasonal = array('d', [math.nan if v is None else v for v in state['seasonal']][:n * self.SLOTS])
+            self.slot_sum = array('d', state['slot_sum'][:n])
+            self.slot_count = array('d', state['slot_count'][:n])
+            self.current_slot = state.get('current_slot')
+            self.count = int(state.get('count', 0))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Failed to load anomaly baseline: {e}")
+
+    def summary(self):
+        with self.lock:
+            filled = min(self.recent_count, self.window)
+            slot_of_day = self.slot_of(time.time())
+            result = {'samples': self.count}
+            for i, metric in enumerate(self.METRICS):
+                recent = self.recent[i * self.window:i * self.window + filled]
+                seasonal = self.seasonal[i * self.SLOTS + slot_of_day]
+                result[metric] = {
+                    'mean': round(self.mean[i], 2),
+                    'std': round(math.sqrt(self.var[i]), 2),
+                    'long_term': round(self.long_mean[i], 2),
+                    'seasonal': None if math.isnan(seasonal) else round(seasonal, 2),
+                    'min': round(min(recent), 2) if filled else None,
+                    'max': round(max(recent), 2) if filled else None,
+                    'anomalous': self.active[i]
+                }
+            return result
+
+# --- CONNECTION TRACKING ---
+def _split_hostport(value):
+    # "1.2.3.4:443", "[2001:db8::1]:443" (ss) or "2001:db8::1[443]" (pfctl)
+    if value.endswith(']'):
+        host, _, port = value[:-1].rpartition('[')
+    else:
+        host, _, port = value.rpartition(':')
+        host = host.strip('[]')
+    host = host.split('%')[0]
+    if host[:7].lower() == '::ffff:' and '.' in host:
+        host = host[7:]     # IPv4-mapped socket on a dual-stack listener
+    return host, int(port) if port.isdigit() else None
+
+def _is_internal(ip):
+    try:
+        return ipaddress.ip_address(ip).is_private
+    except ValueError:
+        return False
+
+def _dedupe_states(states, max_pending):
+    """
+    Firewall states -> one flow per connection. A routed connection has an "in" state on the ingress
+    interface and an "out" state on the egress one, both for the same pre-NAT initiator -> responder
+    5-tuple. Out states are kept; in states are held back and dropped once their out state shows up,
+    the rest (connections terminating on the firewall itself) are yielded at the end.
+    States are (proto, direction, src_ip, src_port, dst_ip, dst_port, bytes) with src the initiator.
+    """
+    internal = {}
+    seen = set()
+    pending = {}
+
+    def is_internal(ip):
+        if ip not in internal:
+            internal[ip] = _is_internal(ip)
+        return internal[ip]
+
+    for proto, direction, src_ip, src_port, dst_ip, dst_port, nbytes in states:
+        key = (proto, src_ip, src_port, dst_ip, dst_port)
+        if direction == 'out':
+            seen.add(key)
+            pending.pop(key, None)
+            # Credit the internal side: LAN hosts for outbound, the server for port forwards
+            if is_internal(dst_ip) and not is_internal(src_ip):
+                yield (proto, dst_ip, dst_port, src_ip, src_port, dst_port, None, nbytes)
+            else:
+                yield (proto, src_ip, src_port, dst_ip, dst_port, dst_port, None, nbytes)
+        elif key not in seen:
+            flow = (proto, dst_ip, dst_port, src_ip, src_port, dst_port, None, nbytes)
+            if len(pending) < max_pending:
+                pending[key] = flow
+            else:
+                yield flow
+    yield from pending.values()
+
+def _stream_lines(command, max_seconds):
+    # Yield a command's output line by line; the process is killed at the deadline or when the consumer stops
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, start_new_session=True)
+
+    def kill():
+        # Kill the whole process group so no child keeps the pipe open past the deadline
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(max_seconds, kill)
+    timer.start()
+    try:
+        yield from p.stdout
+    finally:
+        timer.cancel()
+        kill()
+        p.wait()
+
+class ConnectionTracker:
+    """
+    Turns connection/state table snapshots into top-talker summaries in a single pass.
+    Flows are (proto, local_ip, local_port, remote_ip, remote_port, service_port, process, bytes) tuples;
+    service_port is the listening/responder side, so inbound connections group by the port they hit.
+    bytes is a cumulative counter (or None) and is diffed against the previous snapshot for rates.
+    """
+
+    def __init__(self, max_flows=200000, max_seconds=5.0):
+        self.max_flows = max_flows
+        self.max_seconds = max_seconds
+        self.previous = {}
+        self.previous_ts = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _top(table, top_n, label):
+        ranked = heapq.nlargest(top_n, table.items(), key=lambda item: (item[1][1], item[1][0]))
+        return [{label: key, 'connections': count, 'bytes_per_sec': round(rate, 1)} for key, (count, rate) in ranked]
+
+    def summarize(self, flows, top_n=10):
+        top_n = max(1, min(top_n, 100))
+        with self.lock:
+            now = time.time()
+            deadline = now + self.max_seconds
+            elapsed = now - self.previous_ts if self.previous_ts else None
+            previous = self.previous
+            current = {}
+            by_ip, by_port, by_process = {}, {}, {}
+            top_flows = []     # min-heap of (rate, key), never larger than top_n
+            total = matched = 0
+            truncated = False
+
+            for proto, local_ip, local_port, remote_ip, remote_port, service_port, process, nbytes in flows:
+                if total >= self.max_flows or ((total & 1023) == 0 and time.time() > deadline):
+                    truncated = True
+                    break
+                total += 1
+                key = (proto, local_ip, local_port, remote_ip, remote_port)
+                current[key] = nbytes
+
+                rate = 0.0
+                if key in previous:
+                    matched += 1
+                    before = previous[key]
+                    if elapsed and nbytes is not None and before is not None and nbytes >= before:
+                        rate = (nbytes - before) / elapsed
+
+                for table, group in ((by_ip, remote_ip), (by_port, service_port), (by_process, process)):
+                    if group is None:
+                        continue
+                    entry = table.get(group)
+                    if entry is None:
+                        table[group] = [1, rate]
+                    else:
+                        entry[0] += 1
+                        entry[1] += rate
+
+                if rate > 0:
+                    if len(top_flows) < top_n:
+                        heapq.heappush(top_flows, (rate, key))
+                    elif rate > top_flows[0][0]:
+                        heapq.heapreplace(top_flows, (rate, key))
+
+            if hasattr(flows, 'close'):
+                flows.close()
+            # Sources stop at the deadline on their own (killed command, last page), so check again here
+            if time.time() > deadline:
+                truncated = True
+            # A truncated snapshot keeps the old counters so the next full one still has a baseline
+            if not truncated:
+                self.previous = current
+                self.previous_ts = now
+
+            top_ips = self._top(by_ip, top_n, 'ip')
+            for entry in top_ips:
+                entry['intel'] = ip_intel.lookup(entry['ip'])
+
+            return {
+                'flows': total,
+                'new': total - matched,
+                'closed': len(previous) - matched if not truncated else None,
+                'interval': round(elapsed, 1) if elapsed else None,
+                'truncated': truncated,
+                'top_remote_ips': top_ips,
+                'top_ports': self._top(by_port, top_n, 'port'),
+                'top_processes': self._top(by_process, top_n, 'process'),
+                'top_flows': [
+                    {'proto': k[0], 'local': f'{k[1]}:{k[2]}', 'remote': f'{k[3]}:{k[4]}', 'bytes_per_sec': round(r, 1)}
+                    for r, k in sorted(top_flows, reverse=True)
+                ]
+            }
+
 class BaseAgent:
     def __init__(self):
         self.id = AGENT_ID
         self.platform = platform.system()
         self.hostname = platform.node()
+        self.anomalies = AnomalyDetector(state_file='anomaly_baseline.json', **config.get('anomaly_detection', {}))
+        self.connections = ConnectionTracker(**config.get('connection_tracking', {}))
+
+    def save_baselines(self):
+        self.anomalies.save()
 
     def get_stats(self):
         try:
@@ -96,6 +565,40 @@ class BaseAgent:
             logger.error(f"Error collecting stats: {e}")
             return {}
 
+    def check_anomalies(self, stats):
+        for anomaly in self.anomalies.update(stats):
+            anomaly['id'] = self.id
+            logger.warning(f"📈 Anomaly: {anomaly['metric']}={anomaly['value']} (baseline {anomaly['baseline']}, z={anomaly['z']})")
+            emit_anomaly(anomaly)
+
+    def collect_flows(self):
+        names = {}
+        conns = psutil.net_connections(kind='inet')
+        listening = {conn.laddr.port for conn in conns if conn.status == psutil.CONN_LISTEN}
+        for conn in conns:
+            if not conn.raddr:
+                continue
+            process = None
+            if conn.pid:
+                if conn.pid not in names:
+                    try:
+                        names[conn.pid] = psutil.Process(conn.pid).name()
+                    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                        names[conn.pid] = None
+                process = names[conn.pid]
+            proto = 'tcp' if conn.type == socket.SOCK_STREAM else 'udp'
+            service = conn.laddr.port if conn.laddr.port in listening else conn.raddr.port
+            yield (proto, conn.laddr.ip, conn.laddr.port, conn.raddr.ip, conn.raddr.port, service, process, None)
+
+    def registrations(self):
+        return [{'id': self.id, 'platform': self.platform, 'hostname': self.hostname}]
+
+    def start(self):
+        pass
+
+    def submit_command(self, agent_id, command_key, payload, done):
+        done(self.execute_command(command_key, payload))
+
     def _run_safe(self, command_list):
         try:
             result = subprocess.run(command_list, capture_output=True, text=True, timeout=10)
@@ -105,7 +608,40 @@ class BaseAgent:
 
     def execute_command(self, command_key, payload=None):
         if payload is None: payload = {}
-        return "Command not implemented"
+
+        if command_key == 'get_connections':
+            try:
+                top_n = int(payload.get('top', 10))
+            except (TypeError, ValueError):
+                return "Error: 'top' must be an integer"
+            try:
+                return self.connections.summarize(self.collect_flows(), top_n=top_n)
+            except Exception as e:
+                return f"Error: {e}"
+        elif command_key == 'get_baseline':
+            return self.anomalies.summary()
+        elif command_key == 'set_heartbeat_interval':
+            try:
+                interval = int(payload.get('interval', 5))
+            except (TypeError, ValueError):
+                return "Error: Invalid interval"
+            config['heartbeat_interval'] = max(5, min(interval, 3600))
+            try:
+                save_config()
+            except OSError as e:
+                return f"⚠️ Heartbeat interval set to {config['heartbeat_interval']}s but not saved: {e}"
+            return f"✅ Heartbeat interval set to {config['heartbeat_interval']}s"
+        elif command_key == 'get_version':
+            return {'version': AGENT_VERSION, 'sha256': file_sha256(AGENT_FILE)}
+        elif command_key == 'lookup_ip':
+            return ip_intel.lookup(payload.get('ip')) or f"No intel for {payload.get('ip')}"
+        elif command_key == 'update_agent':
+            try:
+                return updater.check(force=bool(payload.get('force')))
+            except Exception as e:
+                return f"❌ Update Failed: {e}"
+
+        return f"Unknown {self.platform} Command: {command_key}"
 
 class WindowsAgent(BaseAgent):
     def execute_command(self, command_key, payload=None):
@@ -139,9 +675,52 @@ class WindowsAgent(BaseAgent):
             except Exception as e:
                 return f"❌ Error: {e}"
         
-        return f"Unknown Windows Command: {command_key}"
+        return super().execute_command(command_key, payload)
 
 class LinuxAgent(BaseAgent):
+    def collect_flows(self):
+        # ss streams sockets with their owning process and byte counters, instead of
+        # building the whole table in memory like psutil.net_connections()
+        if not shutil.which('ss'):
+            yield from super().collect_flows()
+            return
+        # Sockets on a listening port are inbound: their service port is the local one
+        listening = set()
+        for line in _stream_lines(['ss', '-tulnH'], self.connections.max_seconds):
+            parts = line.split()
+            if len(parts) >= 5:
+                listening.add((parts[0], _split_hostport(parts[4])[1]))
+        lines = _stream_lines(['ss', '-tunipH'], self.connections.max_seconds)
+        try:
+            flow = None
+            for line in lines:
+                if line[:1].isspace():
+                    if flow:
+                        sent = re.search(r'bytes_acked:(\d+)', line)
+                        received = re.search(r'bytes_received:(\d+)', line)
+                        yield flow + ((int(sent.group(1)) if sent else 0) + (int(received.group(1)) if received else 0),)
+                        flow = None
+                    continue
+                if flow:
+                    yield flow + (None,)
+                    flow = None
+                # "tcp ESTAB 0 0 10.0.0.5:5123 1.2.3.4:443 users:(("curl",pid=42,fd=3))"
+                parts = line.split()
+                if len(parts) < 6:
+                    continue
+                local_ip, local_port = _split_hostport(parts[4])
+                remote_ip, remote_port = _split_hostport(parts[5])
+                if remote_port is None:
+                    continue
+                process = re.search(r'users:\(\("([^"]*)"', line)
+                service = local_port if (parts[0], local_port) in listening else remote_port
+                flow = (parts[0], local_ip, local_port, remote_ip, remote_port, service,
+                        process.group(1) if process else None)
+            if flow:
+                yield flow + (None,)
+        finally:
+            lines.close()
+
     def execute_command(self, command_key, payload=None):
         if payload is None: payload = {}
 
@@ -175,18 +754,140 @@ class LinuxAgent(BaseAgent):
             except Exception as e:
                 return f"❌ Error: {e}"
         
-        return f"Unknown Linux Command: {command_key}"
+        return super().execute_command(command_key, payload)
+
+# --- OPNSENSE API CLIENT ---
+class CircuitOpenError(Exception):
+    pass
+
+class OPNsenseClient:
+    # (connect, read) timeouts by endpoint prefix, longest prefix wins
+    DEFAULT_TIMEOUTS = {
+        '': (3, 10),
+        'diagnostics/log': (3, 10),
+        'core/backup': (3, 60),
+        'unbound/service/reconfigure': (3, 60),
+        'diagnostics/firewall/query_states': (3, 30),
+    }
+
+    def __init__(self, base_url, key, secret, verify=False, pool_size=4, retries=2,
+                 failure_threshold=5, reset_timeout=30, timeouts=None):
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeouts = dict(self.DEFAULT_TIMEOUTS)
+        self.timeouts.update({k: tuple(v) for k, v in (timeouts or {}).items()})
+
+        # Keep-alive pool; retries are handled here so they can be limited to idempotent calls.
+        # The pool never blocks: when every kept-alive connection is busy (e.g. a wedged reconfigure)
+        # callers open an extra connection instead of waiting outside their timeouts.
+        self.session = requests.Session()
+        self.session.auth = (key, secret)
+        self.session.verify = verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0, pool_block=False)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.metrics = {}
+
+    def _timeout(self, path):
+        prefix = max((p for p in self.timeouts if path.startswith(p)), key=len)
+        return self.timeouts[prefix]
+
+    @staticmethod
+    def _endpoint(path):
+        # Group metrics by module/controller/action, dropping trailing IDs (uuids, alias names)
+        return '/'.join(path.split('?')[0].split('/')[:3])
+
+    def _before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"OPNsense API unavailable, retrying after {self.reset_timeout}s cooldown")
+            # Half-open: let this call probe the API, keep others out until it reports back
+            self.opened_at = time.time()
+
+    def _after_call(self, endpoint, elapsed, ok):
+        with self.lock:
+            stat = self.metrics.setdefault(endpoint, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0, 'recent': deque(maxlen=100)})
+            stat['count'] += 1
+            stat['total'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+            stat['recent'].append(elapsed)
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                stat['errors'] += 1
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    if self.opened_at is None:
+                        logger.warning(f"OPNsense API circuit opened after {self.failures} failures")
+                    self.opened_at = time.time()
+
+    def request(self, method, path, idempotent=None, **kwargs):
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+        endpoint = self._endpoint(path)
+        kwargs.setdefault('timeout', self._timeout(path))
+        attempts = 1 + (self.retries if idempotent else 0)
+
+        for attempt in range(attempts):
+            self._before_call()
+            start = time.perf_counter()
+            try:
+                res = self.session.request(method, f'{self.base_url}/{path}', **kwargs)
+            except requests.RequestException:
+                self._after_call(endpoint, time.perf_counter() - start, ok=False)
+                if attempt + 1 >= attempts:
+                    raise
+            else:
+                ok = res.status_code < 500
+                self._after_call(endpoint, time.perf_counter() - start, ok=ok)
+                if ok or attempt + 1 >= attempts:
+                    return res
+            # Jittered exponential backoff so retries from many callers do not line up
+            time.sleep(min(5.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def get_metrics(self):
+        with self.lock:
+            summary = {}
+            for endpoint, stat in self.metrics.items():
+                recent = sorted(stat['recent'])
+                summary[endpoint] = {
+                    'count': stat['count'],
+                    'errors': stat['errors'],
+                    'avg_ms': round(stat['total'] / stat['count'] * 1000, 1),
+                    'p95_ms': round(recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000, 1),
+                    'max_ms': round(stat['max'] * 1000, 1)
+                }
+            return {'circuit': 'open' if self.opened_at else 'closed', 'endpoints': summary}
 
 class OPNsenseAgent(LinuxAgent):
+    # Commands served purely through the OPNsense API (usable against remote firewalls too)
+    API_COMMANDS = {'check_logs', 'get_logs', 'backup_config', 'block_ip', 'block_app',
+                    'unblock_app', 'get_blocked_apps', 'get_api_metrics', 'get_baseline', 'get_connections'}
+
     def __init__(self):
         super().__init__()
+        self.blocked_apps = blocked_apps_state
         self.api_key = config.get('opnsense_key')
         self.api_secret = config.get('opnsense_secret')
-        self.api_url = config.get('opnsense_url')
+        self.api_url = config.get('opnsense_url', 'https://localhost/api')
         
-        self.session = requests.Session()
-        self.session.auth = (self.api_key, self.api_secret)
-        self.session.verify = False 
+        self.client = OPNsenseClient(self.api_url, self.api_key, self.api_secret,
+                                     timeouts=config.get('opnsense_timeouts'))
 
     def execute_command(self, command_key, payload=None):
         if payload is None: payload = {}
@@ -194,7 +895,7 @@ class OPNsenseAgent(LinuxAgent):
         if command_key == 'check_logs' or command_key == 'get_logs':
             try:
                 # Real OPNsense Log Endpoint
-                res = self.session.get(f'{self.api_url}/diagnostics/log/core/firewall', timeout=5)
+                res = self.client.get('diagnostics/log/core/firewall')
                 if res.status_code == 200:
                     return res.json()['rows'][:50]
                 return f"API Error {res.status_code}: {res.text}"
@@ -203,7 +904,7 @@ class OPNsenseAgent(LinuxAgent):
         
         elif command_key == 'backup_config':
             try:
-                res = self.session.get(f'{self.api_url}/core/backup/download', stream=True)
+                res = self.client.get('core/backup/download')
                 if res.status_code == 200:
                     # In production, upload this to cloud storage
                     return f"✅ Backup Success: {len(res.content)} bytes retrieved."
@@ -217,12 +918,12 @@ class OPNsenseAgent(LinuxAgent):
                 if not ip: return "Error: No IP"
                 
                 # 1. Add to Alias
-                endpoint = f'{self.api_url}/firewall/alias_util/add/ARUSHI_BLOCKLIST'
-                res = self.session.post(endpoint, json={'address': ip})
+                # Adding an address that is already present is a no-op, so this is safe to retry
+                res = self.client.post('firewall/alias_util/add/ARUSHI_BLOCKLIST', json={'address': ip}, idempotent=True)
                 
                 if res.status_code == 200:
                     # 2. Apply Changes is usually automatic for aliases, but can force filter reload
-                    # self.session.post(f'{self.api_url}/firewall/filter/apply')
+                    # self.client.post('firewall/filter/apply')
                     return f"✅ IP {ip} added to Blocklist"
                 return f"Block Failed: {res.text}"
             except Exception as e:
@@ -246,7 +947,7 @@ class OPNsenseAgent(LinuxAgent):
                         "description": f"Arushi Block: {app_name}"
                     }
                     # Note: The exact endpoint depends on plugin version, usually /api/unbound/settings/addHostOverride
-                    res = self.session.post(f'{self.api_url}/unbound/settings/addHostOverride', json={"host_override": data})
+                    res = self.client.post('unbound/settings/addHostOverride', json={"host_override": data})
                     
                     if res.status_code == 200:
                         success_count += 1
@@ -256,11 +957,14 @@ class OPNsenseAgent(LinuxAgent):
                     errors.append(str(e))
             
             # Apply Unbound Changes
-            self.session.post(f'{self.api_url}/unbound/service/reconfigure')
+            try:
+                self.client.post('unbound/service/reconfigure', idempotent=True)
+            except Exception as e:
+                errors.append(f"reconfigure: {e}")
             
             if success_count > 0:
-                blocked_apps_state.add(app_name)
-                save_blocked_apps()
+                self.blocked_apps.add(app_name)
+                self._save_blocked_apps()
                 return f"✅ Blocked {app_name} ({success_count} domains)"
             return f"Failed to block {app_name}: {errors}"
 
@@ -270,7 +974,7 @@ class OPNsenseAgent(LinuxAgent):
             
             # To delete, we first need to find the UUIDs of the overrides
             try:
-                search_res = self.session.get(f'{self.api_url}/unbound/settings/searchHostOverride')
+                search_res = self.client.get('unbound/settings/searchHostOverride')
                 if search_res.status_code == 200:
                     overrides = search_res.json().get('rows', [])
                     deleted_count = 0
@@ -279,26 +983,278 @@ class OPNsenseAgent(LinuxAgent):
                         # Check if this override belongs to our app block
                         if item.get('domain') in domains and f"Arushi Block: {app_name}" in item.get('description', ''):
                             uuid = item.get('uuid')
-                            del_res = self.session.post(f'{self.api_url}/unbound/settings/delHostOverride/{uuid}')
+                            del_res = self.client.post(f'unbound/settings/delHostOverride/{uuid}', idempotent=True)
                             if del_res.status_code == 200:
                                 deleted_count += 1
                     
-                    self.session.post(f'{self.api_url}/unbound/service/reconfigure')
+                    self.client.post('unbound/service/reconfigure', idempotent=True)
                     
-                    if app_name in blocked_apps_state:
-                        blocked_apps_state.remove(app_name)
-                        save_blocked_apps()
+                    if app_name in self.blocked_apps:
+                        self.blocked_apps.remove(app_name)
+                        self._save_blocked_apps()
                         
                     return f"✅ Unblocked {app_name} (Removed {deleted_count} rules)"
             except Exception as e:
                 return f"Unblock Error: {e}"
 
         elif command_key == 'get_blocked_apps':
-            return list(blocked_apps_state)
+            return list(self.blocked_apps)
+
+        elif command_key == 'get_api_metrics':
+            return self.client.get_metrics()
 
         return super().execute_command(command_key, payload)
 
+    def _save_blocked_apps(self):
+        save_blocked_apps()
+
+    def collect_flows(self):
+        # Read the pf state table directly when running on the firewall, otherwise ask the API
+        states = self._pf_states() if shutil.which('pfctl') else self._api_states()
+        return _dedupe_states(states, self.connections.max_flows)
+
+    def _pf_states(self):
+        # pfctl -ss -v: "all tcp 10.0.0.5:5123 -> 1.2.3.4:443  ESTABLISHED:ESTABLISHED"
+        # followed by "   age ..., 10:12 pkts, 1234:5678 bytes, rule 5".
+        # "->" states list the initiator first, "<-" states the responder first (initiator on the right).
+        # Outbound NAT: "all tcp WAN:port (LAN:port) -> remote" (parenthesised = pre-NAT initiator);
+        # inbound rdr:  "all tcp LAN:port (WAN:port) <- remote" (first address = internal target).
+        lines = _stream_lines(['pfctl', '-ss', '-v'], self.connections.max_seconds)
+        try:
+            state = None
+            for line in lines:
+                if line[:1].isspace():
+                    counters = re.search(r'(\d+):(\d+) bytes', line)
+                    if state and counters:
+                        yield state + (int(counters.group(1)) + int(counters.group(2)),)
+                        state = None
+                    continue
+                if state:
+                    yield state + (None,)
+                parts = line.split()
+                arrow = next((i for i, part in enumerate(parts) if part in ('->', '<-')), None)
+                state = None
+                if arrow is not None and arrow + 1 < len(parts):
+                    left = parts[2]
+                    if parts[arrow] == '->' and parts[3].startswith('('):
+                        left = parts[3].strip('()')
+                    left_ip, left_port = _split_hostport(left)
+                    right_ip, right_port = _split_hostport(parts[arrow + 1])
+                    if parts[arrow] == '->':
+                        state = (parts[1], 'out', left_ip, left_port, right_ip, right_port)
+                    else:
+                        state = (parts[1], 'in', right_ip, right_port, left_ip, left_port)
+            if state:
+                yield state + (None,)
+        finally:
+            lines.close()
+
+    def _api_states(self, page_size=1000):
+        # Page through the state table; the tracker stops consuming (and so paging) at its flow/time limits.
+        # Rows list the initiator as src; on outbound NAT states nat_addr/nat_port hold the pre-NAT host.
+        deadline = time.time() + self.connections.max_seconds
+        page = 1
+        while True:
+            res = self.client.post('diagnostics/firewall/query_states',
+                                   data={'current': page, 'rowCount': page_size}, idempotent=True)
+            if res.status_code != 200:
+                raise ValueError(f"API Error {res.status_code}")
+            rows = res.json().get('rows', [])
+            for row in rows:
+                nbytes = row.get('bytes')
+                if isinstance(nbytes, list):
+                    nbytes = sum(int(n) for n in nbytes)
+                direction = 'in' if row.get('direction') == 'in' else 'out'
+                src_ip, src_port = row.get('src_addr'), row.get('src_port')
+                if direction == 'out' and row.get('nat_addr'):
+                    src_ip, src_port = row.get('nat_addr'), row.get('nat_port') or src_port
+                yield (row.get('proto'), direction, src_ip, src_port, row.get('dst_addr'), row.get('dst_port'),
+                       int(nbytes) if nbytes is not None else None)
+            if len(rows) < page_size or page * page_size >= self.connections.max_flows or time.time() > deadline:
+                return
+            page += 1
+
+# --- PROXY MODE (REMOTE OPNSENSE FLEET) ---
+class RemoteOPNsenseAgent(OPNsenseAgent):
+    """An OPNsense firewall managed over its API from a proxy host, registered as its own agent."""
+
+    def __init__(self, fw):
+        BaseAgent.__init__(self)
+        self.api_url = fw['url']
+        self.id = fw.get('agent_id') or str(uuid.uuid5(uuid.NAMESPACE_URL, self.api_url))
+        self.anomalies = AnomalyDetector(state_file=f'anomaly_baseline_{self.id}.json',
+                                         **config.get('anomaly_detection', {}))
+        self.platform = 'FreeBSD'
+        self.hostname = fw.get('name') or urlparse(self.api_url).hostname
+        self.client = OPNsenseClient(self.api_url, fw['key'], fw['secret'], verify=fw.get('verify', False),
+                                     pool_size=2, timeouts=config.get('opnsense_timeouts'))
+        self.alerts_seen = None     # newest alert timestamp already forwarded
+        self.alerts_seen_keys = set()  # alerts sharing that timestamp, so none are dropped or repeated
+
+        self.blocked_apps_file = f'blocked_apps_{self.id}.json'
+        self.blocked_apps = set()
+        if os.path.exists(self.blocked_apps_file):
+            try:
+                with open(self.blocked_apps_file, 'r') as f:
+                    self.blocked_apps = set(json.load(f))
+            except (OSError, ValueError):
+                pass
+
+    def _save_blocked_apps(self):
+        with open(self.blocked_apps_file, 'w') as f:
+            json.dump(list(self.blocked_apps), f)
+
+    def collect_flows(self):
+        return _dedupe_states(self._api_states(), self.connections.max_flows)
+
+    def get_stats(self):
+        stats = {}
+        try:
+            memory = self.client.get('diagnostics/system/systemResources').json().get('memory', {})
+            total, used = float(memory.get('total', 0)), float(memory.get('used', 0))
+            if total:
+                stats['ram'] = round(used / total * 100, 1)
+
+            devices = self.client.get('diagnostics/system/systemDisk').json().get('devices', [])
+            root = next((d for d in devices if d.get('mountpoint') == '/'), None)
+            if root:
+                stats['disk'] = float(str(root.get('used_pct', 0)).rstrip('%'))
+
+            # top(1) header lines: "CPU: ... 97.9% idle" and "... up 5+01:02:03 ..."
+            for line in self.client.get('diagnostics/activity/getActivity').json().get('headers', []):
+                idle = re.search(r'([\d.]+)% idle', line)
+                if idle:
+                    stats['cpu'] = round(100 - float(idle.group(1)), 1)
+                up = re.search(r'up (\d+)\+(\d+):', line)
+                if up:
+                    stats['uptime'] = int(up.group(1)) * 24 + int(up.group(2))
+        except Exception as e:
+            logger.warning(f"[{self.hostname}] Stats failed: {e}")
+        return stats
+
+    ALERT_PAGE_SIZE = 200
+    ALERT_MAX_PAGES = 50
+
+    @staticmethod
+    def _alert_key(row):
+        return (row.get('timestamp', ''), row.get('flow_id') or row.get('filepos'), row.get('alert_sid'),
+                row.get('src_ip'), row.get('dest_ip'))
+
+    def pull_alerts(self):
+        # Newest first, paging back until the watermark; a failed page leaves the watermark alone for a retry
+        rows = []
+        for page in range(1, self.ALERT_MAX_PAGES + 1):
+            res = self.client.post('ids/service/queryAlerts', idempotent=True, data={
+                'current': page, 'rowCount': self.ALERT_PAGE_SIZE, 'sort[timestamp]': 'desc'})
+            if res.status_code != 200:
+                return
+            batch = res.json().get('rows', [])
+            rows.extend(batch)
+            # The first pull only needs the newest page to set the watermark
+            if (self.alerts_seen is None or len(batch) < self.ALERT_PAGE_SIZE
+                    or any(row.get('timestamp', '') < self.alerts_seen for row in batch)):
+                break
+        if not rows:
+            return
+
+        fresh = {}
+        for row in rows:
+            key = self._alert_key(row)
+            if self.alerts_seen is None or key[0] > self.alerts_seen or (
+                    key[0] == self.alerts_seen and key not in self.alerts_seen_keys):
+                fresh[key] = row    # rows shifted across pages by new alerts collapse here
+
+        if self.alerts_seen is not None:
+            for key in sorted(fresh, key=lambda key: key[0]):
+                row = fresh[key]
+                threat_payload = build_threat_payload(row.get('src_ip'), row.get('dest_ip'), row.get('proto'),
+                                                      row.get('alert'), row.get('alert_sev'))
+                if threat_payload:
+                    threat_payload['agentId'] = self.id
+                    emit_alert(threat_payload)
+
+        newest = max([key[0] for key in fresh] + [self.alerts_seen or ''])
+        if newest != self.alerts_seen:
+            self.alerts_seen_keys = set()
+            self.alerts_seen = newest
+        self.alerts_seen_keys.update(key for key in fresh if key[0] == newest)
+
+    def execute_command(self, command_key, payload=None):
+        # Host commands (ping, syslog, processes) would run on the proxy, not the firewall
+        if command_key in self.API_COMMANDS:
+            return super().execute_command(command_key, payload)
+        return f"Unknown Remote OPNsense Command: {command_key}"
+
+class ProxyAgent(LinuxAgent):
+    """Runs on a Linux collector host and manages many remote OPNsense firewalls concurrently."""
+
+    def __init__(self, firewalls):
+        super().__init__()
+        self.firewalls = {}
+        for fw in firewalls:
+            remote = RemoteOPNsenseAgent(fw)
+            self.firewalls[remote.id] = remote
+        self.pool = ThreadPoolExecutor(max_workers=config.get('proxy_workers', 32), thread_name_prefix='proxy')
+        self.inflight = set()
+        self.lock = threading.Lock()
+
+    def registrations(self):
+        info = super().registrations()
+        for fw in self.firewalls.values():
+            info.append({'id': fw.id, 'platform': fw.platform, 'hostname': fw.hostname, 'proxy': self.id})
+        return info
+
+    def save_baselines(self):
+        super().save_baselines()
+        for fw in self.firewalls.values():
+            fw.save_baselines()
+
+    def start(self):
+        logger.info(f"🛰️ Proxy mode: managing {len(self.firewalls)} OPNsense firewalls")
+        jobs = (
+            ('heartbeat', self._heartbeat, config.get('proxy_heartbeat_interval', 15)),
+            ('alerts', lambda fw: fw.pull_alerts(), config.get('proxy_alert_interval', 30)),
+        )
+        for name, job, interval in jobs:
+            threading.Thread(target=self._schedule, args=(name, job, interval), daemon=True).start()
+
+    def _schedule(self, name, job, interval):
+        while True:
+            started = time.time()
+            for fw in list(self.firewalls.values()):
+                key = (name, fw.id)
+                # At most one job of each kind per firewall in flight, so a slow firewall cannot pile up work
+                with self.lock:
+                    if key in self.inflight:
+                        continue
+                    self.inflight.add(key)
+                self.pool.submit(self._run, key, job, fw)
+            time.sleep(max(0.0, interval - (time.time() - started)))
+
+    def _run(self, key, job, fw):
+        try:
+            job(fw)
+        except Exception as e:
+            logger.warning(f"[{fw.hostname}] {key[0]} failed: {e}")
+        finally:
+            with self.lock:
+                self.inflight.discard(key)
+
+    def _heartbeat(self, fw):
+        stats = fw.get_stats()
+        if stats:
+            fw.check_anomalies(stats)
+            stats['id'] = fw.id
+            send_heartbeat(stats)
+
+    def submit_command(self, agent_id, command_key, payload, done):
+        target = self.firewalls.get(agent_id)
+        if target is None:
+            return super().submit_command(agent_id, command_key, payload, done)
+        self.pool.submit(lambda: done(target.execute_command(command_key, payload)))
+
 def get_agent():
+    if config.get('proxy_firewalls'): return ProxyAgent(config['proxy_firewalls'])
     system = platform.system()
     if system == 'Windows': return WindowsAgent()
     elif system == 'Linux': return LinuxAgent()
@@ -307,10 +1263,204 @@ def get_agent():
 
 agent = get_agent()
 
+# --- AUTO-UPDATER ---
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def parse_version(version):
+    try:
+        return tuple(int(part) for part in str(version).split('.'))
+    except ValueError:
+        return (0,)
+
+def apply_delta(base, delta):
+    # Delta ops: ["copy", offset, length] reuses bytes of the installed file, ["data", b64] inserts new bytes
+    out = bytearray()
+    for op in delta.get('ops', []):
+        if op[0] == 'copy':
+            offset, length = int(op[1]), int(op[2])
+            if offset < 0 or length < 0 or offset + length > len(base):
+                raise ValueError("Delta copy out of range")
+            out += base[offset:offset + length]
+        elif op[0] == 'data':
+            out += base64.b64decode(op[1])
+        else:
+            raise ValueError(f"Unknown delta op: {op[0]}")
+    return bytes(out)
+
+def rollout_delay(manifest):
+    """
+    Seconds to wait before installing this release, or None if this agent is not in the current stage.
+    The slot is derived from the agent ID so it is random across the fleet but stable across restarts.
+    """
+    rollout = manifest.get('rollout') or {}
+    seed = hashlib.sha256(f"{AGENT_ID}:{manifest.get('version')}".encode()).hexdigest()
+    bucket = int(seed[:8], 16)
+
+    if bucket % 100 >= rollout.get('percent', 100):
+        return None
+
+    window = int(rollout.get('window', 0))
+    slot = rollout.get('start', 0) + (int(seed[8:16], 16) % window if window > 0 else 0)
+    return max(0.0, slot - time.time())
+
+class AutoUpdater:
+    def __init__(self, agent_file=AGENT_FILE):
+        self.agent_file = agent_file
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.retry_in = None
+
+    def fetch_manifest(self):
+        res = self.session.get(f'{SERVER_URL}/api/version', timeout=10)
+        res.raise_for_status()
+        return res.json()
+
+    def download(self, manifest, current):
+        expected = manifest.get('sha256')
+        if not expected:
+            raise ValueError("Manifest has no sha256")
+
+        # 1. Delta patch against the installed file
+        current_hash = hashlib.sha256(current).hexdigest()
+        try:
+            res = self.session.get(f'{SERVER_URL}/download/agent/patch/{current_hash}', timeout=30)
+            if res.status_code == 200:
+                data = apply_delta(current, res.json())
+                if hashlib.sha256(data).hexdigest() == expected:
+                    logger.info(f"⬇️ Applied delta patch ({len(res.content)} bytes for {len(data)} byte release)")
+                    return data
+                logger.warning("Delta patch failed hash verification, falling back to full download")
+        except Exception as e:
+            logger.warning(f"Delta patch unavailable: {e}")
+
+        # 2. Full download
+        res = self.session.get(f'{SERVER_URL}/download/agent', timeout=60)
+        res.raise_for_status()
+        if hashlib.sha256(res.content).hexdigest() != expected:
+            raise ValueError("Downloaded agent failed hash verification")
+        return res.content
+
+    def install(self, data):
+        # Refuse anything that would not compile, then swap atomically; the .bak is restored by
+        # the rollback guard if the new version never connects
+        compile(data, self.agent_file, 'exec')
+        tmp = self.agent_file + '.new'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.copy2(self.agent_file, self.agent_file + '.bak')
+        os.replace(tmp, self.agent_file)
+
+    @staticmethod
+    def failed_release():
+        try:
+            with open(UPDATE_FAILED_FILE, 'r') as f:
+                return json.load(f).get('sha256')
+        except (OSError, ValueError):
+            return None
+
+    def check(self, force=False):
+        with self.lock:
+            self.retry_in = None
+            manifest = self.fetch_manifest()
+            with open(self.agent_file, 'rb') as f:
+                current = f.read()
+
+            if manifest.get('sha256') == hashlib.sha256(current).hexdigest():
+                return f"Agent is up to date ({AGENT_VERSION})"
+            if not force and manifest.get('sha256') == self.failed_release():
+                return f"Update {manifest.get('version')} was rolled back on this agent, skipping"
+            # Same version with a different hash is a rebuilt release, so only skip older versions
+            if not force and parse_version(manifest.get('version')) < parse_version(AGENT_VERSION):
+                return f"Agent is newer than release {manifest.get('version')} ({AGENT_VERSION})"
+
+            if not force:
+                delay = rollout_delay(manifest)
+                if delay is None:
+                    return f"Update {manifest.get('version')} not yet rolled out to this agent"
+                if delay > 0:
+                    self.retry_in = delay
+                    return f"Update {manifest.get('version')} scheduled in {int(delay)}s"
+
+            self.install(self.download(manifest, current))
+            # Marker is checked at every start; the update is only kept once connect() confirms it
+            with open(UPDATE_PENDING_FILE, 'w') as f:
+                json.dump({'version': manifest.get('version'), 'sha256': manifest.get('sha256'),
+                           'previous': AGENT_VERSION, 'starts': 0}, f)
+            logger.info(f"✅ Installed agent {manifest.get('version')}, restarting...")
+
+        # Give the command result a moment to reach the server before the process is replaced
+        threading.Timer(1.0, restart_agent).start()
+        return f"✅ Updated to {manifest.get('version')}, restarting"
+
+updater = AutoUpdater()
+
+def restart_agent():
+    # Stop the main loop, then take queue_lock for good so nothing touches the queues mid-snapshot
+    restarting.set()
+    try:
+        if sio.connected:
+            sio.disconnect()
+    except Exception:
+        pass
+    queue_lock.acquire()
+
+    for attempt in range(3):
+        try:
+            save_handover()
+            break
+        except Exception as e:
+            logger.error(f"Handover save failed (attempt {attempt + 1}): {e}")
+            time.sleep(0.5)
+    agent.save_baselines()
+
+    try:
+        os.execv(sys.executable, [sys.executable, AGENT_FILE] + sys.argv[1:])
+    except OSError as e:
+        logger.error(f"Restart failed, still running {AGENT_VERSION}: {e}")
+        queue_lock.release()
+        restarting.clear()
+
+def confirm_update():
+    if os.path.exists(UPDATE_PENDING_FILE):
+        os.remove(UPDATE_PENDING_FILE)
+        logger.info(f"✅ Update to {AGENT_VERSION} confirmed")
+
+def update_confirm_timeout():
+    # Started but never reached the server: put the previous version back
+    if os.path.exists(UPDATE_PENDING_FILE):
+        logger.error(f"Update to {AGENT_VERSION} did not connect in time, rolling back")
+        restore_previous_agent("did not connect in time")
+        restart_agent()
+
+def auto_update_loop():
+    interval = config.get('update_interval', 3600)
+    # Spread the first check so a fleet restarting together does not poll together
+    time.sleep(random.uniform(60, max(60, interval)))
+    while True:
+        try:
+            result = updater.check()
+            logger.info(f"🔄 Update check: {result}")
+        except Exception as e:
+            logger.error(f"Update check failed: {e}")
+
+        wait = interval * random.uniform(0.8, 1.2)
+        if updater.retry_in is not None:
+            wait = min(wait, updater.retry_in + random.uniform(0, 30))
+        time.sleep(wait)
+
 @sio.event
 def connect():
     logger.info("Connected to server!")
-    sio.emit('register_agent', {'id': agent.id, 'platform': agent.platform, 'hostname': agent.hostname})
+    confirm_update()
+    for info in agent.registrations():
+        sio.emit('register_agent', info)
 
 @sio.on('execute_command')
 def on_execute_command(data):
@@ -318,8 +1468,251 @@ def on_execute_command(data):
     payload = data.get('payload')
     dashboard_id = data.get('id')
     logger.info(f"Executing: {command_key}")
-    output = agent.execute_command(command_key, payload)
-    sio.emit('command_result', {'dashboardId': dashboard_id, 'result': {'output': output}})
+    agent.submit_command(data.get('agentId'), command_key, payload,
+                         lambda output: sio.emit('command_result', {'dashboardId': dashboard_id, 'result': {'output': output}}))
+
+# --- IP INTELLIGENCE (LOCAL INDEX) ---
+# CSV feeds in INTEL_DIR (one list per file, named after the file) are compiled into a single
+# memory-mapped index of sorted, non-overlapping ranges. Columns: network (CIDR) or start,end
+# plus optional country, asn, reputation.
+INTEL_DIR = config.get('intel_dir', 'ip_intel')
+INTEL_INDEX_FILE = config.get('intel_index', 'ip_intel.idx')
+INTEL_MAGIC = b'AIPX'
+INTEL_INDEX_VERSION = 2
+INTEL_V4 = struct.Struct('>IIIB')     # start, end, info index, prefix length of the source range
+INTEL_V6 = struct.Struct('>16s16sIB')
+
+def _flatten_ranges(ranges):
+    # Split overlapping ranges into disjoint segments; the most specific (innermost) range wins
+    segments = []
+    stack = []
+    cursor = 0
+
+    def emit(start, end, info):
+        if start > end: return
+        if segments and segments[-1][2] == info and segments[-1][1] + 1 == start:
+            segments[-1] = (segments[-1][0], end, info)
+        else:
+            segments.append((start, end, info))
+
+    for start, end, info in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        while stack and stack[-1][1] < start:
+            top = stack.pop()
+            emit(cursor, top[1], top[2])
+            cursor = max(cursor, top[1] + 1)
+        if stack:
+            emit(cursor, start - 1, stack[-1][2])
+        stack.append((start, end, info))
+        cursor = start
+
+    while stack:
+        top = stack.pop()
+        emit(cursor, top[1], top[2])
+        cursor = max(cursor, top[1] + 1)
+    return segments
+
+def _parse_intel_row(row):
+    if row.get('network'):
+        net = ipaddress.ip_network(row['network'].strip(), strict=False)
+        first, last = net.network_address, net.broadcast_address
+    else:
+        first = ipaddress.ip_address(row['start'].strip())
+        last = ipaddress.ip_address(row['end'].strip())
+    if first.version != last.version:
+        raise ValueError("Mixed address families")
+    reputation = (row.get('reputation') or '').strip()
+    info = (
+        (row.get('country') or '').strip() or None,
+        (row.get('asn') or '').strip() or None,
+        int(reputation) if reputation else None
+    )
+    return first.version, int(first), int(last), info
+
+def build_intel_index(feed_dir=INTEL_DIR, index_file=INTEL_INDEX_FILE):
+    feeds = []
+    blobs = []
+    offset = 0
+
+    for path in sorted(glob.glob(os.path.join(feed_dir, '*.csv'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        infos = {}
+        ranges = {4: [], 6: []}
+        with open(path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    version, first, last, info = _parse_intel_row(row)
+                except (ValueError, KeyError, AttributeError):
+                    continue
+                # Prefix length of the original range, so lookups across feeds can prefer the narrowest match
+                prefix = (32 if version == 4 else 128) - (last - first).bit_length()
+                ranges[version].append((first, last, (infos.setdefault(info, len(infos)), prefix)))
+
+        feed = {'name': name, 'info': list(infos)}
+        for version, record in ((4, INTEL_V4), (6, INTEL_V6)):
+            segments = _flatten_ranges(ranges[version])
+            blob = bytearray(record.size * len(segments))
+            for i, (first, last, (info, prefix)) in enumerate(segments):
+                if version == 4:
+                    record.pack_into(blob, i * record.size, first, last, info, prefix)
+                else:
+                    record.pack_into(blob, i * record.size, first.to_bytes(16, 'big'), last.to_bytes(16, 'big'), info, prefix)
+            feed[f'v{version}'] = [offset, len(segments)]
+            blobs.append(blob)
+            offset += len(blob)
+        feeds.append(feed)
+
+    header = json.dumps({'version': INTEL_INDEX_VERSION, 'feeds': feeds}).encode()
+    tmp = index_file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(INTEL_MAGIC + struct.pack('>I', len(header)) + header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp, index_file)
+    logger.info(f"🌍 Built IP intel index: {len(feeds)} feeds, {offset} bytes")
+
+class IPIntelIndex:
+    def __init__(self, feed_dir=INTEL_DIR, index_file=INTEL_INDEX_FILE):
+        self.feed_dir = feed_dir
+        self.index_file = index_file
+        self.state = None       # (mmap, data offset, feeds) swapped as one reference
+        self.loaded_mtime = None
+
+    def refresh(self):
+        # Rebuild when a feed is newer than the index, then (re)map the index if it changed
+        try:
+            feed_mtimes = [os.path.getmtime(p) for p in glob.glob(os.path.join(self.feed_dir, '*.csv'))]
+            index_mtime = os.path.getmtime(self.index_file) if os.path.exists(self.index_file) else None
+            if feed_mtimes and (index_mtime is None or max(feed_mtimes) > index_mtime):
+                build_intel_index(self.feed_dir, self.index_file)
+                index_mtime = os.path.getmtime(self.index_file)
+            if index_mtime is not None and index_mtime != self.loaded_mtime:
+                if not self._load() and feed_mtimes:
+                    # Index written by an older agent version
+                    build_intel_index(self.feed_dir, self.index_file)
+                    index_mtime = os.path.getmtime(self.index_file)
+                    self._load()
+                self.loaded_mtime = index_mtime
+        except Exception as e:
+            logger.error(f"IP intel refresh failed: {e}")
+
+    def _load(self):
+        with open(self.index_file, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:4] != INTEL_MAGIC:
+            raise ValueError("Not an IP intel index")
+        header_len = struct.unpack_from('>I', mm, 4)[0]
+        header = json.loads(mm[8:8 + header_len])
+        if header.get('version') != INTEL_INDEX_VERSION:
+            return False
+        self.state = (mm, 8 + header_len, header['feeds'])
+        return True
+
+    @staticmethod
+    def _find(mm, base, count, record, key):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if record.unpack_from(mm, base + mid * record.size)[0] <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        _, end, info, prefix = record.unpack_from(mm, base + (lo - 1) * record.size)
+        return (info, prefix) if key <= end else None
+
+    def lookup(self, ip):
+        state = self.state
+        if state is None or not ip:
+            return None
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        mm, data_offset, feeds = state
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped    # ::ffff:1.2.3.4 from dual-stack sockets
+        if addr.version == 4:
+            family, record, key = 'v4', INTEL_V4, int(addr)
+        else:
+            family, record, key = 'v6', INTEL_V6, addr.packed
+
+        result = {}
+        lists = []
+        best = {}       # field -> prefix length of the range that supplied it
+        for feed in feeds:
+            offset, count = feed[family]
+            match = self._find(mm, data_offset + offset, count, record, key)
+            if match is None:
+                continue
+            info, prefix = match
+            country, asn, reputation = feed['info'][info]
+            lists.append(feed['name'])
+            # Country/ASN come from the narrowest matching range across all feeds
+            for field, value in (('country', country), ('asn', asn)):
+                if value and prefix > best.get(field, -1):
+                    result[field] = value
+                    best[field] = prefix
+            if reputation is not None:
+                result['reputation'] = max(result.get('reputation', reputation), reputation)
+
+        if not lists:
+            return None
+        result['lists'] = lists
+        return result
+
+ip_intel = IPIntelIndex()
+ip_intel.refresh()
+
+def intel_refresh_loop():
+    # Own timer: the log tail can block on readline() for as long as no alerts arrive
+    while True:
+        time.sleep(60)
+        try:
+            ip_intel.refresh()
+        except Exception as e:
+            logger.error(f"Intel refresh failed: {e}")
+
+def build_threat_payload(src_ip, dest_ip, proto, signature, severity):
+    threat_payload = {
+        'src_ip': src_ip,
+        'dest_ip': dest_ip,
+        'proto': proto,
+        'signature': signature,
+        'severity': severity,
+        'src_intel': ip_intel.lookup(src_ip),
+        'dest_intel': ip_intel.lookup(dest_ip)
+    }
+    # Drop noise from known scanners / allow-listed ranges on the agent
+    suppress_lists = set(config.get('intel_suppress_lists', []))
+    if suppress_lists and any(
+        suppress_lists.intersection(intel['lists'])
+        for intel in (threat_payload['src_intel'], threat_payload['dest_intel']) if intel
+    ):
+        return None
+    return threat_payload
+
+def send_heartbeat(stats):
+    if sio.connected:
+        sio.emit('heartbeat', stats)
+    else:
+        with queue_lock:
+            queue_heartbeat(stats)
+
+def emit_anomaly(payload):
+    if sio.connected:
+        sio.emit('anomaly', payload)
+    else:
+        with queue_lock:
+            anomaly_queue.append(payload)
+
+def emit_alert(payload):
+    if sio.connected:
+        sio.emit('threat_alert', payload)
+    else:
+        with queue_lock:
+            alert_queue.append(payload)
 
 # --- THREAT MONITORING (REAL LOGS) ---
 def monitor_threats():
@@ -341,53 +1734,72 @@ def monitor_threats():
                         # Only care about alerts
                         if data.get('event_type') == 'alert':
                             alert = data.get('alert', {})
-                            threat_payload = {
-                                'src_ip': data.get('src_ip'),
-                                'dest_ip': data.get('dest_ip'),
-                                'proto': data.get('proto'),
-                                'signature': alert.get('signature'),
-                                'severity': alert.get('severity')
-                            }
-                            if sio.connected:
-                                sio.emit('threat_alert', threat_payload)
+                            threat_payload = build_threat_payload(data.get('src_ip'), data.get('dest_ip'), data.get('proto'),
+                                                                  alert.get('signature'), alert.get('severity'))
+                            if threat_payload:
+                                emit_alert(threat_payload)
                     except json.JSONDecodeError:
                         pass
         except Exception as e:
             logger.error(f"Threat Monitor Failed: {e}")
 
 def main():
-    logger.info(f"Starting Arushi Cloud Agent (ID: {AGENT_ID[:8]}...)")
+    logger.info(f"Starting Arushi Cloud Agent v{AGENT_VERSION} (ID: {AGENT_ID[:8]}...)")
     
     # Start Threat Monitor thread
     t = threading.Thread(target=monitor_threats, daemon=True)
     t.start()
+    threading.Thread(target=intel_refresh_loop, daemon=True).start()
+
+    # Opt-in: installs staged releases on their own; update_agent still works on demand
+    if config.get('auto_update', False):
+        threading.Thread(target=auto_update_loop, daemon=True).start()
+    if os.path.exists(UPDATE_PENDING_FILE):
+        timer = threading.Timer(config.get('update_confirm_seconds', 300), update_confirm_timeout)
+        timer.daemon = True
+        timer.start()
+
+    agent.start()
     
     psutil.cpu_percent(interval=None)
-    msg_queue = [] 
+    last_heartbeat = 0
 
     while True:
         try:
+            if restarting.is_set():
+                time.sleep(1)
+                continue
             if not sio.connected:
                 sio.connect(SERVER_URL, auth={'token': API_KEY})
             
-            while sio.connected:
+            while sio.connected and not restarting.is_set():
+                # Sample every 5s for anomaly detection; full heartbeats go out at heartbeat_interval
                 stats = agent.get_stats()
+                agent.check_anomalies(stats)
                 stats['id'] = agent.id
                 
-                while msg_queue:
-                    old_stats = msg_queue.pop(0)
-                    sio.emit('heartbeat', old_stats)
-                    time.sleep(0.1)
+                # Current heartbeat first so a backlog never delays live data
+                if time.time() - last_heartbeat >= config.get('heartbeat_interval', 5):
+                    sio.emit('heartbeat', stats)
+                    last_heartbeat = time.time()
 
-                sio.emit('heartbeat', stats)
+                with queue_lock:
+                    for queue in [heartbeat_queue] + list(proxy_heartbeat_queues.values()):
+                        while queue:
+                            sio.emit('heartbeat', queue.popleft())
+                    while alert_queue:
+                        sio.emit('threat_alert', alert_queue.popleft())
+                    while anomaly_queue:
+                        sio.emit('anomaly', anomaly_queue.popleft())
                 time.sleep(5)
 
         except Exception as e:
             logger.error(f"Connection lost: {e}")
             stats = agent.get_stats()
+            agent.check_anomalies(stats)
             stats['id'] = agent.id
-            msg_queue.append(stats)
-            if len(msg_queue) > 720: msg_queue.pop(0)
+            with queue_lock:
+                queue_heartbeat(stats)
             time.sleep(5)
 
 if __name__ == '__main__':
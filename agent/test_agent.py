@@ -0,0 +1,187 @@
+# Behavior tests for the agent's pure helpers. Run from the repo root: python -m pytest agent
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_JS = os.path.join(AGENT_DIR, '..', 'server', 'server.js')
+
+
+@pytest.fixture(scope='module')
+def agent(tmp_path_factory):
+    # agent.py loads its config and state from the working directory on import
+    workdir = tmp_path_factory.mktemp('agent')
+    with open(workdir / 'agent_config.json', 'w') as f:
+        json.dump({'server_url': 'http://localhost:3000', 'api_key': 'test', 'agent_id': 'test-agent'}, f)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        spec = importlib.util.spec_from_file_location('agent', os.path.join(AGENT_DIR, 'agent.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+    finally:
+        os.chdir(cwd)
+
+
+# --- AUTO-UPDATER ---
+def make_delta(tmp_path, base, target):
+    # Runs the server's makeDelta on the two files and returns the delta it would serve
+    if not shutil.which('node'):
+        pytest.skip('node is not installed')
+    (tmp_path / 'base').write_bytes(base)
+    (tmp_path / 'target').write_bytes(target)
+    script = (
+        "const fs = require('fs');"
+        "const src = fs.readFileSync(process.argv[1], 'utf8');"
+        "eval(src.slice(src.indexOf('function makeDelta'), src.indexOf('function parseRolloutStart')));"
+        "process.stdout.write(JSON.stringify(makeDelta(fs.readFileSync(process.argv[2]), fs.readFileSync(process.argv[3]))));"
+    )
+    out = subprocess.run(['node', '-e', script, SERVER_JS, str(tmp_path / 'base'), str(tmp_path / 'target')],
+                         capture_output=True, check=True)
+    return json.loads(out.stdout)
+
+
+def test_delta_round_trip(agent, tmp_path):
+    with open(os.path.join(AGENT_DIR, 'agent.py'), 'rb') as f:
+        base = f.read()
+    target = base.replace(b'AGENT_VERSION = "', b'AGENT_VERSION = "9.') + b'\n# appended line\n'
+    delta = make_delta(tmp_path, base, target)
+    assert agent.apply_delta(base, delta) == target
+    assert any(op[0] == 'copy' for op in delta['ops'])
+    assert len(json.dumps(delta)) < len(target)
+
+
+def test_delta_unrelated_files(agent, tmp_path):
+    base, target = b'a' * 100, bytes(range(256)) * 4
+    assert agent.apply_delta(base, make_delta(tmp_path, base, target)) == target
+
+
+def test_apply_delta_rejects_out_of_range_copy(agent):
+    with pytest.raises(ValueError):
+        agent.apply_delta(b'abc', {'ops': [['copy', 2, 5]]})
+    with pytest.raises(ValueError):
+        agent.apply_delta(b'abc', {'ops': [['move', 0, 1]]})
+
+
+# --- IP INTELLIGENCE ---
+def test_flatten_ranges_innermost_wins(agent):
+    segments = agent._flatten_ranges([(0, 99, 'outer'), (10, 19, 'inner'), (50, 59, 'inner2'), (95, 120, 'tail')])
+    assert segments == [(0, 9, 'outer'), (10, 19, 'inner'), (20, 49, 'outer'), (50, 59, 'inner2'),
+                        (60, 94, 'outer'), (95, 120, 'tail')]
+
+
+def test_flatten_ranges_merges_adjacent(agent):
+    assert agent._flatten_ranges([(0, 9, 'a'), (10, 19, 'a'), (30, 39, 'b')]) == [(0, 19, 'a'), (30, 39, 'b')]
+
+
+def test_index_lookup(agent, tmp_path):
+    feeds = tmp_path / 'feeds'
+    feeds.mkdir()
+    (feeds / 'asn.csv').write_text('network,country,asn\n10.0.0.0/8,US,AS1\n2001:db8::/32,FR,AS3\n')
+    (feeds / 'geo.csv').write_text('network,country\n10.1.0.0/16,DE\n10.1.0.0/24,NL\n')
+    (feeds / 'scanners.csv').write_text('start,end,reputation\n10.1.2.0,10.1.2.255,90\n')
+    index = agent.IPIntelIndex(str(feeds), str(tmp_path / 'intel.idx'))
+    index.refresh()
+
+    assert index.lookup('10.9.9.9') == {'country': 'US', 'asn': 'AS1', 'lists': ['asn']}
+    # Across feeds the narrowest range with a value supplies each field
+    assert index.lookup('10.1.2.3') == {'country': 'DE', 'asn': 'AS1', 'reputation': 90,
+                                        'lists': ['asn', 'geo', 'scanners']}
+    assert index.lookup('10.1.0.3')['country'] == 'NL'
+    assert index.lookup('::ffff:10.1.2.3') == index.lookup('10.1.2.3')
+    assert index.lookup('2001:db8::1')['country'] == 'FR'
+    assert index.lookup('192.0.2.1') is None
+    assert index.lookup('not-an-ip') is None
+
+
+# --- CONNECTION TRACKING ---
+def fake_commands(monkeypatch, agent, outputs):
+    # Replace the streamed commands with canned output keyed by the command's flags
+    def stream(command, max_seconds):
+        yield from outputs[command[1]].splitlines(True)
+    monkeypatch.setattr(agent, '_stream_lines', stream)
+    monkeypatch.setattr(agent.shutil, 'which', lambda name: f'/sbin/{name}')
+
+
+def test_split_hostport(agent):
+    assert agent._split_hostport('10.0.0.5:443') == ('10.0.0.5', 443)
+    assert agent._split_hostport('[2001:db8::1]:443') == ('2001:db8::1', 443)
+    assert agent._split_hostport('2001:db8::1[443]') == ('2001:db8::1', 443)
+    assert agent._split_hostport('[fe80::1%eth0]:22') == ('fe80::1', 22)
+    assert agent._split_hostport('[::ffff:10.0.0.5]:80') == ('10.0.0.5', 80)
+    assert agent._split_hostport('0.0.0.0:*') == ('0.0.0.0', None)
+
+
+PFCTL = """\
+all tcp 1.2.3.4:443 <- 10.0.0.5:5123       ESTABLISHED:ESTABLISHED
+   age 00:01:00, expires in 24:00:00, 10:12 pkts, 100:200 bytes, rule 5
+all tcp 203.0.113.1:62000 (10.0.0.5:5123) -> 1.2.3.4:443       ESTABLISHED:ESTABLISHED
+   age 00:01:00, expires in 24:00:00, 10:12 pkts, 100:200 bytes, rule 6
+all tcp 10.0.0.9:80 (203.0.113.1:80) <- 93.184.216.34:40000       ESTABLISHED:ESTABLISHED
+   age 00:01:00, expires in 24:00:00, 1:1 pkts, 5:5 bytes, rule 7
+all tcp 93.184.216.34:40000 -> 10.0.0.9:80       ESTABLISHED:ESTABLISHED
+   age 00:01:00, expires in 24:00:00, 1:1 pkts, 5:5 bytes, rule 8
+all tcp 10.0.0.1:443 <- 10.0.0.5:6000       ESTABLISHED:ESTABLISHED
+   age 00:01:00, expires in 24:00:00, 1:1 pkts, 7:7 bytes, rule 9
+all udp 10.0.0.5:53000 -> 8.8.8.8:53       MULTIPLE:SINGLE
+"""
+
+
+def test_pf_states_one_flow_per_connection(agent, monkeypatch):
+    fake_commands(monkeypatch, agent, {'-ss': PFCTL})
+    fw = agent.OPNsenseAgent.__new__(agent.OPNsenseAgent)
+    fw.connections = agent.ConnectionTracker()
+    assert list(fw.collect_flows()) == [
+        # LAN in-state + NATed WAN out-state: one flow, credited to the LAN host
+        ('tcp', '10.0.0.5', 5123, '1.2.3.4', 443, 443, None, 300),
+        # Port forward: the internal server is local, the service is the port it listens on
+        ('tcp', '10.0.0.9', 80, '93.184.216.34', 40000, 80, None, 10),
+        ('udp', '10.0.0.5', 53000, '8.8.8.8', 53, 53, None, None),
+        # In-state without an out-state terminates on the firewall
+        ('tcp', '10.0.0.1', 443, '10.0.0.5', 6000, 443, None, 14),
+    ]
+
+
+SS_LISTEN = """\
+tcp LISTEN 0 4096 0.0.0.0:22 0.0.0.0:*
+tcp LISTEN 0 511 *:443 *:*
+"""
+
+SS_SOCKETS = """\
+tcp ESTAB 0 0 10.0.0.5:22 93.184.216.34:50000 users:(("sshd",pid=1,fd=3))
+\t cubic wscale:7,7 bytes_acked:100 bytes_received:50
+tcp ESTAB 0 0 [::ffff:10.0.0.5]:443 [::ffff:93.184.216.35]:50001 users:(("nginx",pid=2,fd=3))
+tcp ESTAB 0 0 10.0.0.5:40000 1.1.1.1:443 users:(("curl",pid=3,fd=3))
+\t cubic bytes_acked:10
+udp UNCONN 0 0 0.0.0.0:5353 0.0.0.0:*
+"""
+
+
+def test_ss_flows(agent, monkeypatch):
+    fake_commands(monkeypatch, agent, {'-tulnH': SS_LISTEN, '-tunipH': SS_SOCKETS})
+    host = agent.LinuxAgent.__new__(agent.LinuxAgent)
+    host.connections = agent.ConnectionTracker()
+    flows = list(host.collect_flows())
+    assert flows == [
+        ('tcp', '10.0.0.5', 22, '93.184.216.34', 50000, 22, 'sshd', 150),
+        ('tcp', '10.0.0.5', 443, '93.184.216.35', 50001, 443, 'nginx', None),
+        ('tcp', '10.0.0.5', 40000, '1.1.1.1', 443, 443, 'curl', 10),
+    ]
+    summary = host.connections.summarize(iter(flows), top_n=500)
+    assert summary['top_ports'][0] == {'port': 443, 'connections': 2, 'bytes_per_sec': 0.0}
+
+
+def test_tracker_rates_between_snapshots(agent):
+    tracker = agent.ConnectionTracker()
+    flow = ('tcp', '10.0.0.5', 5123, '1.2.3.4', 443, 443, 'curl')
+    tracker.summarize(iter([flow + (1000,)]))
+    tracker.previous_ts -= 10
+    summary = tracker.summarize(iter([flow + (6000,)]))
+    assert summary['new'] == 0 and summary['closed'] == 0
+    assert round(summary['top_flows'][0]['bytes_per_sec']) == 500
+    assert summary['top_remote_ips'][0]['ip'] == '1.2.3.4'
@@ -4,6 +4,8 @@ const { Server } = require('socket.io');
 const { createClient } = require('redis');
 const { PrismaClient } = require('@prisma/client');
 const path = require('path');
+const fs = require('fs');
+const crypto = require('crypto');
 
 const { Resend } = require('resend');
 const resend = new Resend(process.env.RESEND_API_KEY);
@@ -125,7 +127,11 @@ io.on('connection', (socket) => {
         agents.set(data.id, { socketId: socket.id, status: 'online', ...data });
         socket.join('agents');
         socket.data.type = 'agent';
-        socket.data.agentId = data.id;
+        // A proxy agent registers every firewall it manages over the same socket; those carry
+        // `proxy` and must not replace the socket's own agent ID (used for unattributed alerts)
+        if (!data.proxy) socket.data.agentId = data.id;
+        socket.data.agentIds = socket.data.agentIds || new Set();
+        socket.data.agentIds.add(data.id);
 
         // Persist to DB
         try {
@@ -161,7 +167,7 @@ io.on('connection', (socket) => {
 
     // --- THREAT INTELLIGENCE RELAY ---
     socket.on('threat_alert', (data) => {
-        const agentId = socket.data.agentId;
+        const agentId = data.agentId || socket.data.agentId;
 
         // Add context and broadcast to dashboard
         const enrichedThreat = {
@@ -197,7 +203,7 @@ io.on('connection', (socket) => {
         const agentData = agents.get(agentId);
 
         if (agentData && agentData.socketId) {
-            io.to(agentData.socketId).emit('execute_command', { command, payload, id: socket.id }); // Pass dashboard socket ID to reply back
+            io.to(agentData.socketId).emit('execute_command', { command, payload, agentId, id: socket.id }); // Pass dashboard socket ID to reply back
             console.log(`Command sent to agent ${agentId}: ${command}`);
             createLog(agentId, 'command', `Executed "${command}"`, 'success');
         } else {
@@ -264,37 +270,46 @@ io.on('connection', (socket) => {
 
         // Optional: Log high severity threats
         if (data.severity <= 1) {
-            createLog(socket.data.agentId, 'alert', `High Severity Threat: ${data.signature} from ${data.src_ip}`, 'error');
+            createLog(data.agentId || socket.data.agentId, 'alert', `High Severity Threat: ${data.signature} from ${data.src_ip}`, 'error');
         }
     });
 
+    // Anomaly: Agent -> Server -> Dashboard (pushed only when a metric leaves its baseline)
+    socket.on('anomaly', (data) => {
+        const agentId = data.id || socket.data.agentId;
+        io.to('dashboard').emit('anomaly_update', { ...data, agentId, timestamp: new Date().toISOString() });
+        createLog(agentId, 'alert', `Anomaly: ${data.metric} at ${data.value}% (baseline ${data.baseline}%)`, 'error');
+    });
+
     socket.on('disconnect', () => {
         if (socket.data.type === 'agent') {
-            const agentId = socket.data.agentId;
-            console.log('Agent disconnected (Starting Grace Period):', agentId);
-
-            // --- NEW: GRACE PERIOD LOGIC ---
-            // Don't mark offline immediately. Wait 30 seconds.
-            const timer = setTimeout(async () => {
-                if (agents.has(agentId)) {
-                    console.log(`Agent ${agentId} confirmed OFFLINE after 30s.`);
-
-                    const agent = agents.get(agentId);
-                    agent.status = 'offline';
-                    agent.socketId = null; // No longer reachable
-                    agents.set(agentId, agent);
-
-                    // Notify dashboard
-                    io.to('dashboard').emit('agent_update', { id: agentId, status: 'offline' });
-
-                    // Trigger Alert
-                    sendAlert(agentId, 'offline');
-                }
-            }, 30000); // 30 seconds
+            const agentIds = socket.data.agentIds || new Set([socket.data.agentId]);
+            for (const agentId of agentIds) {
+                console.log('Agent disconnected (Starting Grace Period):', agentId);
+
+                // --- NEW: GRACE PERIOD LOGIC ---
+                // Don't mark offline immediately. Wait 30 seconds.
+                const timer = setTimeout(async () => {
+                    if (agents.has(agentId)) {
+                        console.log(`Agent ${agentId} confirmed OFFLINE after 30s.`);
+
+                        const agent = agents.get(agentId);
+                        agent.status = 'offline';
+                        agent.socketId = null; // No longer reachable
+                        agents.set(agentId, agent);
+
+                        // Notify dashboard
+                        io.to('dashboard').emit('agent_update', { id: agentId, status: 'offline' });
+
+                        // Trigger Alert
+                        sendAlert(agentId, 'offline');
+                    }
+                }, 30000); // 30 seconds
 
-            // Store timer for this agent
-            disconnectTimers.set(agentId, timer);
-            // -------------------------------
+                // Store timer for this agent
+                disconnectTimers.set(agentId, timer);
+                // -------------------------------
+            }
 
         } else {
             console.log('Client disconnected:', socket.id);
@@ -337,11 +352,143 @@ async function createLog(agentId, type, message, status) {
 const PORT = process.env.PORT || 3000;
 
 // Auto-Updater Endpoints
+// The current release is downloads/agent.py. Older releases placed in downloads/releases/
+// can be patched forward with a delta instead of a full download.
+const AGENT_RELEASE_FILE = path.join(__dirname, 'downloads', 'agent.py');
+const AGENT_RELEASES_DIR = path.join(__dirname, 'downloads', 'releases');
+const PATCH_CACHE_LIMIT = 1000;
+const patchCache = new Map(); // `${fromHash}:${toHash}` -> serialized delta, or null when no useful patch exists
+let releaseCache = null;
+
+function sha256(data) {
+    return crypto.createHash('sha256').update(data).digest('hex');
+}
+
+function loadRelease() {
+    const { mtimeMs } = fs.statSync(AGENT_RELEASE_FILE);
+    if (!releaseCache || releaseCache.mtimeMs !== mtimeMs) {
+        const data = fs.readFileSync(AGENT_RELEASE_FILE);
+        const match = data.toString('utf8').match(/^AGENT_VERSION = "([^"]+)"/m);
+        releaseCache = { mtimeMs, data, sha256: sha256(data), version: match ? match[1] : '1.0.0' };
+        patchCache.clear();
+    }
+    return releaseCache;
+}
+
+// Old releases hashed once and re-read only when the directory changes
+let releaseIndex = null;
+
+function loadReleaseIndex() {
+    if (!fs.existsSync(AGENT_RELEASES_DIR)) return new Map();
+    const { mtimeMs } = fs.statSync(AGENT_RELEASES_DIR);
+    if (!releaseIndex || releaseIndex.mtimeMs !== mtimeMs) {
+        const files = new Map();
+        for (const name of fs.readdirSync(AGENT_RELEASES_DIR)) {
+            const file = path.join(AGENT_RELEASES_DIR, name);
+            files.set(sha256(fs.readFileSync(file)), file);
+        }
+        releaseIndex = { mtimeMs, files };
+        patchCache.clear();
+    }
+    return releaseIndex.files;
+}
+
+// Delta of `target` against `base`: ["copy", offset, length] reuses base bytes, ["data", b64] inserts new ones.
+// Base chunks are indexed by line so unchanged regions of the script turn into copies.
+function makeDelta(base, target) {
+    const MIN_COPY = 16;
+    const MAX_CANDIDATES = 8;
+    const index = new Map();
+    let start = 0;
+    while (start < base.length) {
+        let end = base.indexOf(10, start);
+        end = end === -1 ? base.length : end + 1;
+        const key = base.toString('latin1', start, end);
+        if (!index.has(key)) index.set(key, []);
+        if (index.get(key).length < MAX_CANDIDATES) index.get(key).push(start);
+        start = end;
+    }
+
+    const ops = [];
+    let literalStart = 0;
+    let pos = 0;
+    while (pos < target.length) {
+        let end = target.indexOf(10, pos);
+        end = end === -1 ? target.length : end + 1;
+
+        let bestOffset = -1;
+        let bestLength = 0;
+        for (const offset of index.get(target.toString('latin1', pos, end)) || []) {
+            let length = 0;
+            while (pos + length < target.length && offset + length < base.length && base[offset + length] === target[pos + length]) length++;
+            if (length > bestLength) {
+                bestOffset = offset;
+                bestLength = length;
+            }
+        }
+
+        if (bestLength >= MIN_COPY) {
+            if (literalStart < pos) ops.push(['data', target.subarray(literalStart, pos).toString('base64')]);
+            const last = ops[ops.length - 1];
+            if (last && last[0] === 'copy' && last[1] + last[2] === bestOffset) last[2] += bestLength;
+            else ops.push(['copy', bestOffset, bestLength]);
+            pos += bestLength;
+            literalStart = pos;
+        } else {
+            pos = end;
+        }
+    }
+    if (literalStart < target.length) ops.push(['data', target.subarray(literalStart).toString('base64')]);
+    return { ops };
+}
+
+function parseRolloutStart(value) {
+    if (!value) return 0;
+    const seconds = Number(value);
+    return Number.isNaN(seconds) ? Date.parse(value) / 1000 : seconds;
+}
+
 app.get('/api/version', (req, res) => {
-    res.json({
-        version: "1.0.0",
-        url: `https://arushi-cloud-server-v1.onrender.com/download/agent`
-    });
+    try {
+        const release = loadRelease();
+        res.json({
+            version: release.version,
+            sha256: release.sha256,
+            size: release.data.length,
+            // Agents pick a stable pseudo-random slot inside the window; percent gates staged rollouts
+            rollout: {
+                // Without an explicit start the window opens when the release file was published
+                start: parseRolloutStart(process.env.UPDATE_ROLLOUT_START) || release.mtimeMs / 1000,
+                window: Number(process.env.UPDATE_ROLLOUT_WINDOW || 3600),
+                percent: Number(process.env.UPDATE_ROLLOUT_PERCENT || 100)
+            }
+        });
+    } catch (e) {
+        console.error('Error reading agent release:', e);
+        res.status(500).json({ error: 'Release unavailable' });
+    }
+});
+
+app.get('/download/agent/patch/:fromHash', (req, res) => {
+    try {
+        const release = loadRelease();
+        const releases = loadReleaseIndex(); // before the cache lookup: a new release may turn a cached miss into a hit
+        const key = `${req.params.fromHash}:${release.sha256}`;
+        if (!patchCache.has(key)) {
+            const file = releases.get(req.params.fromHash);
+            let body = file ? JSON.stringify(makeDelta(fs.readFileSync(file), release.data)) : null;
+            // A patch that is not smaller than the release is worse than the full download
+            if (body && Buffer.byteLength(body) >= release.data.length) body = null;
+            if (patchCache.size >= PATCH_CACHE_LIMIT) patchCache.clear();
+            patchCache.set(key, body);
+        }
+        const body = patchCache.get(key);
+        if (!body) return res.status(404).json({ error: 'No patch for this version' });
+        res.type('application/json').send(body);
+    } catch (e) {
+        console.error('Error building patch:', e);
+        res.status(500).json({ error: 'Patch unavailable' });
+    }
 });
 
 app.get('/download/agent', (req, res) => {